@@ -1,24 +1,102 @@
-import random
+import os
+import re
+import select
 import socket
-import urllib.request
 import sys
 import hashlib
-import selectors
 import time
 import threading
 
-TRANSPARENT = '000000'
+import numpy as np
+import requests
+from numba import njit
 
+# keep-alive session shared by all api and image requests
+SESSION = requests.Session()
 
-def version_hash():
+# udp payload that fits a standard 1500-byte MTU
+MTU_PAYLOAD = 1472
+
+# validates a whole image worth of hex digits in one pass
+HEX_RE = re.compile(b'[0-9a-fA-F]*')
+
+# lookup tables for hex encoding and decoding
+HEX_CHARS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+HEX_VALUES = np.zeros(256, dtype=np.uint8)
+for i, char in enumerate(b'0123456789abcdef'):
+    HEX_VALUES[char] = i
+for i, char in enumerate(b'ABCDEF'):
+    HEX_VALUES[char] = 10 + i
+del i, char
+
+
+@njit(cache=True, nogil=True)
+def build_cmds(img_u8, ys, xs, x_str, y_str, out):
     """
-    Compute a short hash of the code file, for debugging purposes
+    Write one fixed-width PX record for each of the given pixels into out
+
+    :param img_u8: the image as uint8 array of shape (h, w, channels)
+    :type img_u8: np.ndarray(dtype=np.uint8)
+
+    :param ys: the y-indices of the visible pixels
+    :type ys: np.ndarray(dtype=np.intp)
+
+    :param xs: the x-indices of the visible pixels
+    :type xs: np.ndarray(dtype=np.intp)
+
+    :param x_str: the precomputed x-coordinate strings of shape (w, xw)
+    :type x_str: np.ndarray(dtype=np.uint8)
+
+    :param y_str: the precomputed y-coordinate strings of shape (h, yw)
+    :type y_str: np.ndarray(dtype=np.uint8)
+
+    :param out: the preallocated records of shape (len(ys), record length)
+    :type out: np.ndarray(dtype=np.uint8)
     """
+    c = img_u8.shape[2]
+    xw = x_str.shape[1]
+    yw = y_str.shape[1]
+
+    for i in range(len(ys)):
+        y = ys[i]
+        x = xs[i]
+        rec = out[i]
+        rec[0] = 80  # 'P'
+        rec[1] = 88  # 'X'
+        rec[2] = 32  # ' '
+        for j in range(xw):
+            rec[3 + j] = x_str[x, j]
+        rec[3 + xw] = 32  # ' '
+        for j in range(yw):
+            rec[4 + xw + j] = y_str[y, j]
+        pos = 4 + xw + yw
+        rec[pos] = 32  # ' '
+        pos += 1
+        for k in range(c):
+            val = img_u8[y, x, k]
+            rec[pos] = HEX_CHARS[val >> 4]
+            rec[pos + 1] = HEX_CHARS[val & 0xf]
+            pos += 2
+        rec[pos] = 10  # '\n'
+
+
+def _compute_version_hash():
     with open(__file__, 'r') as f:
         hash_md5 = hashlib.md5(f.read().encode())
     return hash_md5.hexdigest()[:16]
 
 
+# computed once at import, main() runs in a restart loop
+_VERSION = _compute_version_hash()
+
+
+def version_hash():
+    """
+    Return a short hash of the code file, for debugging purposes
+    """
+    return _VERSION
+
+
 def call_api(px_cnt=0, ver=''):
     """
     Call command and control API
@@ -39,7 +117,7 @@ def call_api(px_cnt=0, ver=''):
     # request commands and report
     api_url = '{url}?pxc={px_cnt}&ver={ver}'.format(
         url=api_url, px_cnt=px_cnt, ver=ver)
-    response = urllib.request.urlopen(api_url).read().decode()
+    response = SESSION.get(api_url).text
 
     if 'Error' in response:
         raise Exception(response)
@@ -63,22 +141,59 @@ def load_img(url):
     :param url: the url
     :type url: str
 
-    :returns: the image as nested list
+    :returns: the image as uint8 array of shape (h, w, channels)
     """
     print('Retrieving image...', end='', flush=True)
 
-    lines = urllib.request.urlopen(url).read()
+    lines = SESSION.get(url).content
     lines = lines.decode('utf-8').split('\n')[:-1]
 
-    img = []
-    for line in lines:
-        img.append(line.replace(' ', '').split(','))
+    # let numpy size the dtype to the longest token, so overlong values
+    # are caught below instead of being silently truncated
+    arr = np.array([line.replace(' ', '').split(',') for line in lines])
+    h, w = arr.shape
+
+    # validate rgb values are hex and of uniform, right length
+    lengths = np.char.str_len(arr)
+    length = int(lengths[0, 0])
+    if not np.all(lengths == length) or (length != 6 and length != 8):
+        raise ValueError('RGB(A) Value has wrong length')
+    arr = arr.astype('S8')
+    if not HEX_RE.fullmatch(arr.tobytes().replace(b'\0', b'')):
+        raise ValueError('RGB(A) Value is not hexadecimal')
 
-    print(' Done. New image dimensions:', len(img[0]), len(img))
+    # decode the hex digits into a contiguous uint8 image
+    digits = np.frombuffer(arr.tobytes(), dtype=np.uint8).reshape(h, w, 8)
+    nibbles = HEX_VALUES[digits[:, :, :length]]
+    img = np.ascontiguousarray(
+        (nibbles[:, :, 0::2] << 4) | nibbles[:, :, 1::2])
+
+    print(' Done. New image dimensions:', w, h)
 
     return img
 
 
+def coord_strs(offset, count, width):
+    """
+    Precompute the zero-padded ASCII coordinate strings for one axis
+
+    :param offset: the first coordinate
+    :type offset: int
+
+    :param count: the number of coordinates
+    :type count: int
+
+    :param width: the number of characters per coordinate
+    :type width: int
+
+    :returns: uint8 array of shape (count, width)
+    """
+    coords = np.arange(offset, offset + count).astype('U{}'.format(width))
+    coords = np.char.zfill(coords, width).astype('S{}'.format(width))
+    return np.frombuffer(coords.tobytes(), dtype=np.uint8).reshape(
+        count, width)
+
+
 def get_cmds(dx, dy, img):
     """
     Compute the command string for the shuffeled image pixels
@@ -89,30 +204,31 @@ def get_cmds(dx, dy, img):
     :param dy: y-offset
     :type dy: int
 
-    :param img: the image as nested lists of rgb-values
-    :type img: list(list(str))
+    :param img: the image as uint8 array of shape (h, w, channels)
+    :type img: np.ndarray(dtype=np.uint8)
 
-    :returns: (command string, number of pixels)
+    :returns: the commands as uint8 records of shape (n, record length)
     """
     print('Updating command string...', end='', flush=True)
-    h = len(img)
-    w = len(img[0])
-
-    cmds = []
-    for y in range(h):
-        for x in range(w):
-            rgb = img[y][x]
-
-            # ignore transparent color
-            if rgb == TRANSPARENT:
-                continue
-
-            # validate rgb value is hex and of right length
-            int(rgb, 16)
-            if len(rgb) != 6 and len(rgb) != 8:
-                raise ValueError('RGB(A) Value has wrong length')
-            cmds.append('PX {xx} {yy} {rgb}\n'.format(
-                xx=x+dx, yy=y+dy, rgb=rgb).encode())
+    h, w, c = img.shape
+
+    # visit only the visible pixels, the transparent color is masked out
+    # up front (an rgba image has no transparent color)
+    if c == 3:
+        ys, xs = np.nonzero(img.any(axis=2))
+    else:
+        ys, xs = np.divmod(np.arange(h * w), w)
+
+    # fixed-width records: 'PX ' + x + ' ' + y + ' ' + rgb(a) + '\n',
+    # with zero-padded coordinates from per-axis lookup tables
+    xw = max(len(str(dx)), len(str(w - 1 + dx)))
+    yw = max(len(str(dy)), len(str(h - 1 + dy)))
+    x_str = coord_strs(dx, w, xw)
+    y_str = coord_strs(dy, h, yw)
+
+    cmds = np.empty((len(ys), 3 + xw + 1 + yw + 1 + 2 * c + 1),
+                    dtype=np.uint8)
+    build_cmds(img, ys, xs, x_str, y_str, cmds)
 
     print(' Done.')
 
@@ -120,25 +236,102 @@ def get_cmds(dx, dy, img):
 
 
 class Sender():
-    def __init__(self, max_socks=16):
+    def __init__(self, max_socks=16, num_threads=None, mode='tcp'):
+        if num_threads is None:
+            num_threads = min(os.cpu_count() or 1, max_socks)
         self.max_socks = max_socks
-        self.sel = selectors.DefaultSelector()
+        self.num_threads = num_threads
+        self.mode = mode
+        # one edge-triggered epoll per worker thread, sockets are
+        # sharded round-robin
+        self.eps = [select.epoll() for _ in range(num_threads)]
+        self.fds = {}
         self.buf = {}
-        self.px_cnt = 0.0
-        self.cmd_str = {}
+        self.rng = np.random.default_rng()
+        self.px_cnt = [0.0] * num_threads
+        self.cur = (None, 0)
+        self.old_fd = None
+        self.cmd_buf = memoryview(b'')
+        self.dgram_size = 0
+        # serializes rebuilds and reconnects, two concurrent
+        # set_cmd_list calls would race on old_fd/cur and could close
+        # the same fd twice
+        self.lock = threading.Lock()
 
     def get_px_cnt(self):
-        px_cnt = self.px_cnt
-        self.px_cnt = 0.0
+        px_cnt = sum(self.px_cnt)
+        self.px_cnt = [0.0] * self.num_threads
         return int(px_cnt)
 
     def set_cmd_list(self, cmds):
-        for v in self.sel.get_map().values():
-            sock = v.fileobj
-            random.shuffle(cmds)
-            self.cmd_str[sock] = b''.join(cmds)
-        self.px_per_str = len(cmds)
-        self.chars_per_cmd_str = len(list(self.cmd_str.values())[0])
+        with self.lock:
+            # shuffle the fixed-width records in C and share one buffer
+            self.rng.shuffle(cmds, axis=0)
+            cmd_str = cmds.tobytes()
+
+            self.px_per_str = len(cmds)
+            self.chars_per_cmd_str = len(cmd_str)
+
+            if self.mode == 'udp':
+                # pack as many whole commands as fit into one MTU payload
+                self.dgram_size = 0
+                if len(cmds):
+                    self.dgram_size = max(MTU_PAYLOAD // cmds.shape[1], 1) \
+                        * cmds.shape[1]
+                self.cmd_buf = memoryview(cmd_str)
+            else:
+                # back the next-generation buffer with an in-memory file,
+                # so the kernel can splice it into the sockets without a
+                # userspace copy
+                fd = os.memfd_create('cmd_str')
+                # a short write would leave the file smaller than the
+                # size published below and stall sendfile at EOF
+                written = 0
+                while written < len(cmd_str):
+                    written += os.write(fd, memoryview(cmd_str)[written:])
+                if self.old_fd is not None:
+                    os.close(self.old_fd)
+                # keep the previous fd alive for sends still in flight
+                self.old_fd = self.cur[0]
+
+                # publish the new buffer with one atomic assignment, the
+                # senders keep streaming the old one until the
+                # wrap-around
+                self.cur = (fd, len(cmd_str))
+
+            # desynchronize the sockets by rotating each one to a random
+            # command boundary of the shared buffer
+            for sock_fd, (sock, shard) in list(self.fds.items()):
+                offset = 0
+                if len(cmds):
+                    offset = int(self.rng.integers(len(cmds))) \
+                        * cmds.shape[1]
+                if self.mode == 'udp':
+                    self.buf[sock] = (self.cmd_buf, offset)
+                else:
+                    self.buf[sock] = (self.cur[0], len(cmd_str), offset)
+                    # re-arm: a sender that ran dry before this buffer
+                    # existed never gets another edge on its own,
+                    # modify re-queues a wakeup while the socket is
+                    # writable
+                    self.eps[shard].modify(sock_fd, self.eventmask())
+
+    def eventmask(self):
+        """
+        epoll event mask for sockets of the current mode
+
+        :returns: EPOLLOUT, edge-triggered for stream sockets
+        :rtype: int
+        """
+        # edge-triggered: epoll only wakes the worker up when the
+        # socket turns writable again, not on every poll. Datagram
+        # sockets are virtually always writable and would starve their
+        # shard in edge-triggered mode, so they stay level-triggered
+        # and send bounded bursts instead.
+        mask = select.EPOLLOUT
+        if self.mode != 'udp':
+            mask |= select.EPOLLET
+        return mask
 
     def connect(self, hostname, port):
         """
@@ -156,49 +349,193 @@ class Sender():
 
         for i in range(self.max_socks):
             try:
-                sock = socket.create_connection((hostname, port))
+                if self.mode == 'udp':
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.connect((hostname, port))
+                else:
+                    sock = socket.create_connection((hostname, port))
             except ConnectionRefusedError:
                 break
 
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2**18)
-            self.sel.register(sock, selectors.EVENT_WRITE, self.send)
+            if self.mode != 'udp':
+                # disable Nagle
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # give the kernel a big send buffer
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2**22)
             sock.setblocking(0)
 
-        if len(self.sel.get_map()) < 1:
+            shard = i % self.num_threads
+
+            # steer kernel-side processing of this flow to the core the
+            # shard's worker is pinned to, keeping the socket buffers
+            # local to the sending thread's NUMA node
+            if hasattr(socket, 'SO_INCOMING_CPU'):
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_INCOMING_CPU,
+                                    shard % (os.cpu_count() or 1))
+                except OSError:
+                    pass
+
+            self.eps[shard].register(sock.fileno(), self.eventmask())
+            self.fds[sock.fileno()] = (sock, shard)
+
+        num_socks = len(self.fds)
+        if num_socks < 1:
             raise ConnectionRefusedError('Could not connect with any socket.')
 
-        print(' Connected with {} sockets.'.format(len(self.sel.get_map())))
+        print(' Connected with {} sockets.'.format(num_socks))
 
     def disconnect(self):
         """
         Disconnect sockets
         """
-        for v in self.sel.get_map().values():
-            sock = v.fileobj
-            self.sel.unregister(sock)
+        for fd, (sock, shard) in list(self.fds.items()):
+            self.eps[shard].unregister(fd)
+            try:
+                # let the wall drop its end right away
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             sock.close()
+            del self.fds[fd]
+        # drop the per-socket offsets too: a stale entry has the tuple
+        # shape of the old mode and would blow up send() on the new
+        # one, and it pins the dead socket and its old command buffer
+        self.buf.clear()
+
+    def close(self):
+        """
+        Tear the sender down completely before a restart: the wall
+        sockets, the command memfds and the per-shard epolls
 
-    def send(self, sock):
+        disconnect alone is not enough, the reconnect path relies on
+        it keeping the memfds alive
+        """
+        with self.lock:
+            self.disconnect()
+            for fd in (self.cur[0], self.old_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.cur = (None, 0)
+            self.old_fd = None
+            for ep in self.eps:
+                ep.close()
+
+    def send(self, sock, shard=0):
         """
         Send data to server
 
         :param sock: the socket
         :type sock: socket.socket
+
+        :param shard: index of the worker owning the socket
+        :type shard: int
         """
-        data = self.buf.get(sock, b'')
-        sent = sock.send(data)
-        self.buf[sock] = data[sent:]
-        if len(data) == 0:
-            self.buf[sock] = self.cmd_str.get(sock, b'')
+        if self.mode == 'udp':
+            self.send_dgrams(sock, shard)
+            return
+
+        # edge-triggered: keep writing until the kernel buffer is full,
+        # the next wakeup only comes once the socket drains
+        while True:
+            cur_fd, cur_size = self.cur
+            fd, size, offset = self.buf.get(sock, (cur_fd, cur_size, 0))
+            if offset >= size:
+                # wrap around to the start of the (possibly new) buffer
+                fd, size, offset = cur_fd, cur_size, 0
+
+            if fd is None or size == 0:
+                return
+
+            # zero-copy: the kernel splices the memfd into the socket
+            try:
+                sent = os.sendfile(sock.fileno(), fd, offset, size - offset)
+            except BlockingIOError:
+                return
+            if sent == 0:
+                return
+            self.buf[sock] = (fd, size, offset + sent)
 
-        self.px_cnt += float(sent) / self.chars_per_cmd_str * self.px_per_str
+            self.px_cnt[shard] += \
+                float(sent) / self.chars_per_cmd_str * self.px_per_str
 
-    def send_idle(self):
+    def send_dgrams(self, sock, shard=0):
         """
-        Fire idle sockets
+        Send a burst of MTU-sized batches of whole commands as datagrams
+
+        :param sock: the socket
+        :type sock: socket.socket
+
+        :param shard: index of the worker owning the socket
+        :type shard: int
         """
-        for k, v in self.sel.select():
-            self.send(k.fileobj)
+        for _ in range(64):
+            data, offset = self.buf.get(sock, (self.cmd_buf, 0))
+            if offset >= len(data):
+                # wrap around to the start of the (possibly new) buffer
+                data, offset = self.cmd_buf, 0
+
+            if len(data) == 0:
+                return
+
+            try:
+                sent = sock.send(data[offset:offset + self.dgram_size])
+            except BlockingIOError:
+                return
+            self.buf[sock] = (data, offset + sent)
+
+            self.px_cnt[shard] += \
+                float(sent) / self.chars_per_cmd_str * self.px_per_str
+
+    def drop(self, fd):
+        """
+        Drop one dead socket, e.g. after the wall reset the connection
+
+        :param fd: file descriptor of the socket
+        :type fd: int
+        """
+        entry = self.fds.pop(fd, None)
+        if entry is None:
+            return
+        sock, shard = entry
+        self.eps[shard].unregister(fd)
+        self.buf.pop(sock, None)
+        sock.close()
+        print('Lost a socket, {} left.'.format(len(self.fds)))
+
+    def send_idle(self, shard=0):
+        """
+        Fire idle sockets of one shard
+
+        :param shard: index of the worker's epoll
+        :type shard: int
+        """
+        # the timeout keeps the worker responsive once its sockets are
+        # gone, e.g. after a disconnect on another thread
+        try:
+            events = self.eps[shard].poll(1.0)
+        except ValueError:
+            # close() shut this epoll down, exit like on a dead wall
+            raise ConnectionResetError('Sender closed.')
+        for fd, event in events:
+            entry = self.fds.get(fd)
+            if entry is None:
+                # dropped earlier in this batch or by a disconnect
+                continue
+            # BlockingIOError is handled inside send, anything else
+            # escaping here means the wall killed this connection
+            try:
+                self.send(entry[0], shard)
+            except OSError:
+                self.drop(fd)
+
+        if not self.fds:
+            # re-check under the lock, a reconnect holds it while the
+            # socket table is transiently empty
+            with self.lock:
+                if not self.fds:
+                    raise ConnectionResetError('Lost all sockets.')
 
 
 class Loops:
@@ -213,18 +550,41 @@ class Loops:
         max_socks = 128
         if len(sys.argv) > 1:
             max_socks = int(sys.argv[1])
-        self.sender = Sender(max_socks)
+        self.sender = Sender(max_socks, mode=self.mode)
 
         self.sender.connect(self.hostname, self.port)
 
         # precompute wall commands
         self.sender.set_cmd_list(get_cmds(self.dx, self.dy, self.img))
 
+    def rebuild(self):
+        """
+        Rebuild and swap in the command buffer for the current image
+        """
+        self.sender.set_cmd_list(get_cmds(self.dx, self.dy, self.img))
+
     def sending_loop(self):
         print('Let\'s Hölli...')
 
-        while True:
-            self.sender.send_idle()
+        def worker(shard):
+            # pin each worker to its own core
+            try:
+                os.sched_setaffinity(0, {shard % (os.cpu_count() or 1)})
+            except OSError:
+                pass
+            try:
+                while True:
+                    self.sender.send_idle(shard)
+            except ConnectionResetError:
+                if shard == 0:
+                    raise
+                # secondary workers just exit, shard 0 carries the
+                # error into the restart loop
+
+        # one worker thread per shard, shard 0 runs in this thread
+        for shard in range(1, self.sender.num_threads):
+            threading.Thread(target=worker, args=(shard,), daemon=True).start()
+        worker(0)
 
     def api_loop(self):
         while True:
@@ -232,19 +592,32 @@ class Loops:
             ndx, ndy, nurl, nhostname, nport, nmode = call_api(
                 self.sender.get_px_cnt(), self.ver)
 
+            rebuild = False
             if nurl != self.url:
                 self.url = nurl
                 self.img = load_img(self.url)
-                self.sender.set_cmd_list(get_cmds(self.dx, self.dy, self.img))
+                rebuild = True
 
             if ndx != self.dx or ndy != self.dy:
                 self.dx, self.dy = ndx, ndy
-                self.sender.set_cmd_list(get_cmds(self.dx, self.dy, self.img))
-
-            if nhostname != self.hostname or nport != self.port:
-                self.hostname, self.port = nhostname, nport
-                self.sender.disconnect()
-                self.sender.connect(self.hostname, self.port)
+                rebuild = True
+
+            if nhostname != self.hostname or nport != self.port \
+                    or nmode != self.mode:
+                self.hostname, self.port, self.mode = \
+                    nhostname, nport, nmode
+                # hold the lock so the workers do not observe the
+                # transiently empty socket table as a dead connection
+                with self.sender.lock:
+                    self.sender.disconnect()
+                    self.sender.mode = nmode
+                    self.sender.connect(self.hostname, self.port)
+                rebuild = True
+
+            if rebuild:
+                # rebuild off-thread, the senders keep streaming the old
+                # buffer until set_cmd_list swaps in the new one
+                threading.Thread(target=self.rebuild, daemon=True).start()
             time.sleep(10.0)
 
 
@@ -254,10 +627,15 @@ def main():
     print('VERSION: {ver}'.format(ver=ver))
     loops = Loops()
 
-    api_thread = threading.Thread(target=loops.api_loop)
-    api_thread.start()
+    try:
+        api_thread = threading.Thread(target=loops.api_loop)
+        api_thread.start()
 
-    loops.sending_loop()
+        loops.sending_loop()
+    finally:
+        # do not leak sockets, memfds or epolls into the next pass of
+        # the restart loop
+        loops.sender.close()
 
 
 if __name__ == '__main__':
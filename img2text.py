@@ -1,23 +1,21 @@
+import numpy as np
 from skimage.io import imread
 
+# lookup table mapping a channel byte to its two hex characters
+HEX_LUT = np.array(['{:02x}'.format(i) for i in range(256)], dtype='S2')
+
 
 def main():
     img = imread('agdsn.png')
     print(img.shape)
 
-    with open('agdsn.csv', 'w') as f:
-        for y in range(img.shape[0]):
-            line = ''
-            for x in range(img.shape[1]):
-                rgb = f'{img[y, x, 0]:02x}'
-                rgb += f'{img[y, x, 1]:02x}'
-                rgb += f'{img[y, x, 2]:02x}'
-                line += rgb
-
-                if x < img.shape[1] - 1:
-                    line += ', '
+    # map every channel byte to its hex pair and fuse them per pixel
+    h, w = img.shape[:2]
+    rgb = HEX_LUT[img[:, :, :3]].view('S6').reshape(h, w)
 
-            print(line, file=f)
+    with open('agdsn.csv', 'wb') as f:
+        for row in rgb.tolist():
+            f.write(b', '.join(row) + b'\n')
 
 
 if __name__ == '__main__':